@@ -1,16 +1,23 @@
 from keras import Model, regularizers, models
-from keras.layers import Dense, Dropout, Lambda, Layer
+from keras.layers import Dense, Dropout, Layer
 import ns_lib as ns
 import tensorflow as tf
 from ns_lib.nn.constant_embedding import *
 from ns_lib.nn.reasoning import *
-from ns_lib.nn.kge import KGEFactory, KGELayer
+from ns_lib.nn.kge import KGEFactory, KGELayer, sum_and_sigmoid
 from ns_lib.logic import FOL, Rule
 from ns_lib.logic.semantics import GodelTNorm
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 import tensorflow_probability as tfp
 
 
+# Sum over the embedding followed by the sigmoid, see sum_and_sigmoid().
+class SumAndSigmoid(Layer):
+
+    def call(self, x):
+        return sum_and_sigmoid(x)
+
+
 class KGEModel(Model):
 
     def __init__(self, fol:FOL,
@@ -21,11 +28,28 @@ class KGEModel(Model):
                  kge_atom_embedding_size: int,
                  kge_dropout_rate: float,
                  num_adaptive_constants: int=0,
-                 dot_product: bool=False):
+                 dot_product: bool=False,
+                 debug: bool=False):
         super().__init__()
         self.fol = fol
-        self.predicate_index_tensor = tf.constant(
-            [i for i in range(len(self.fol.predicates))], dtype=tf.int32)
+        # Debug prints force a host sync and can not be XLA compiled.
+        self._debug = debug
+        self._domain_order = [d.name for d in fol.domains]
+        self._predicate_arity = fol.predicates[0].arity
+        self._constant_embedding_size = constant_embedding_size
+        assert all(p.arity == self._predicate_arity for p in fol.predicates), (
+            'All predicates must have the same arity')
+        name2domain_idx = {d.name:i for i,d in enumerate(fol.domains)}
+        # Shape (num_predicates, arity) with the domain index of each argument.
+        self._predicate_domain_idx = tf.constant(
+            [[name2domain_idx[d.name] for d in p.domains]
+             for p in fol.predicates], dtype=tf.int32)
+        # Name of the domain of all the predicate arguments, if unique.
+        predicate_domain_names = set(d.name for p in fol.predicates
+                                     for d in p.domains)
+        self._single_domain_name = (predicate_domain_names.pop()
+                                    if len(predicate_domain_names) == 1
+                                    else None)
         self.predicate_embedder = PredicateEmbeddings(
             fol.predicates,
             predicate_embedding_size,
@@ -40,6 +64,10 @@ class KGEModel(Model):
             has_features=False)
         self.dot_product = dot_product
         if num_adaptive_constants > 0:
+            # Constant indices above the threshold are adaptive constants.
+            self._adaptive_thresholds = {
+                domain.name: tf.constant(len(domain.constants), dtype=tf.int32)
+                for domain in fol.domains}
             self.adaptive_constant_embedder = AdaptiveConstantEmbeddings(
                 domains=fol.domains,
                 constant_embedder=self.constant_embedder,
@@ -57,81 +85,125 @@ class KGEModel(Model):
             dropout_rate=kge_dropout_rate)
         assert self.kge_embedder is not None
 
+    def debug_mode(self, mode=True):
+        self._debug = mode
+
+    # Packs the per-domain tensors indexed by the local constant indices in a
+    # single tensor, returning it with the flat local indices shifted into it.
+    def _pack_domains(self, per_domain: Dict[str, tf.Tensor],
+                      flat_pred_idx: tf.Tensor, flat_constant_idx: tf.Tensor):
+        if self._single_domain_name is not None:
+            # All the arguments share the domain, no packing is needed.
+            return per_domain[self._single_domain_name], flat_constant_idx
+        flat_domain_idx = tf.reshape(
+            tf.gather(self._predicate_domain_idx, flat_pred_idx), [-1])
+        # The local constant indices are shifted by the domain offsets.
+        packed, domain_offsets = pack_domain_embeddings(
+            [per_domain[name] for name in self._domain_order])
+        return (packed,
+                flat_constant_idx + tf.gather(domain_offsets, flat_domain_idx))
 
     def create_triplets(self,
-                        constant_embeddings: Dict[str, tf.Tensor],
+                        X_domains: Dict[str, tf.Tensor],
+                        constant_embeddings: Union[Dict[str, tf.Tensor], None],
                         predicate_embeddings: tf.Tensor,
-                        A_predicates: Dict[str, tf.Tensor]):
-        predicate_embeddings_per_triplets = []
-        for p,indices in A_predicates.items():
-            idx = self.fol.name2predicate_idx[p]
-            p_embeddings = tf.expand_dims(predicate_embeddings[idx], axis=0)  # 1E
-            predicate_embeddings_per_triplets.append(
-                tf.repeat(p_embeddings, tf.shape(indices)[0], axis=0)  #PE
-            )
-        predicate_embeddings_per_triplets = tf.concat(predicate_embeddings_per_triplets,
-                                                      axis=0)
-
-        constant_embeddings_for_triplets = []
-        for p,constant_idx in A_predicates.items():
-            constant_idx = tf.cast(constant_idx, tf.int32)
-            predicate = self.fol.name2predicate[p]
-            one_predicate_constant_embeddings = []
-            for i,domain in enumerate(predicate.domains):
-                constants = tf.gather(constant_embeddings[domain.name],
-                                      constant_idx[..., i], axis=0)
-                one_predicate_constant_embeddings.append(constants)
-            # shape (predicate_batch_size, predicate_arity, constant_embedding_size)
-            one_predicate_constant_embeddings = tf.stack(one_predicate_constant_embeddings,
-                                                         axis=-2)
-            constant_embeddings_for_triplets.append(one_predicate_constant_embeddings)
-        constant_embeddings_for_triplets = tf.concat(constant_embeddings_for_triplets,
-                                                     axis=0)
-        tf.debugging.assert_equal(tf.shape(predicate_embeddings_per_triplets)[0],
-                                  tf.shape(constant_embeddings_for_triplets)[0])
+                        A_predicates: Tuple[tf.Tensor, tf.Tensor]):
+        # Shape T and (T, arity) with the predicate index and the local
+        # constant indices of each triplet, in atom index order.
+        flat_pred_idx, constant_idx = A_predicates
+        # Shape TE, the predicate table is already prepared by the KGE.
+        predicate_embeddings_per_triplets = tf.gather(predicate_embeddings,
+                                                      flat_pred_idx)
+
+        # Shape (T*arity) with the local constant index of each triplet
+        # argument, row-major as the (T, arity, E) output. The indices are
+        # int32 as built by the dataset, so no cast is needed.
+        flat_constant_idx = tf.reshape(constant_idx, [-1])
+        if constant_embeddings is None:
+            # Single domain, the embeddings are gathered once from its table
+            # by the constant ids of the triplet arguments.
+            constant_embeddings_for_triplets = tf.gather(
+                self.constant_embedder.domain_weights_matrix(
+                    self._single_domain_name),
+                tf.gather(X_domains[self._single_domain_name],
+                          flat_constant_idx), axis=0)
+        else:
+            embeddings_packed, flat_idx = self._pack_domains(
+                constant_embeddings, flat_pred_idx, flat_constant_idx)
+            constant_embeddings_for_triplets = tf.gather(
+                embeddings_packed, flat_idx, axis=0)
+        # shape (num_triplets, predicate_arity, constant_embedding_size), the
+        # constant tables are kept in float32 and the gathered embeddings are
+        # cast to the compute dtype (bfloat16 under a mixed precision policy).
+        constant_embeddings_for_triplets = tf.reshape(
+            tf.cast(constant_embeddings_for_triplets, self.compute_dtype),
+            [-1, self._predicate_arity, self._constant_embedding_size])
+        # Both come from the same flat atom list, check only when debugging
+        # as the assert syncs with the host at every step.
+        if self._debug:
+            tf.debugging.assert_equal(tf.shape(predicate_embeddings_per_triplets)[0],
+                                      tf.shape(constant_embeddings_for_triplets)[0])
         # Shape TE, T2E with T number of triplets.
         return predicate_embeddings_per_triplets, constant_embeddings_for_triplets
 
-    def call(self, inputs):
+    def call(self, inputs, training=None):
         # X_domains type is Dict[str, inputs]
-        # A_predicate: Dict[predicate_name, List[Tuple[Index1, ..., IndexN]]]
+        # A_predicate: Tuple[predicate_idx [T], constant_indices [T, arity]]
         (X_domains, A_predicates) = inputs
         if self.adaptive_constant_embedder is not None:
-            X_domains_fixed_mask = {
-                name:tf.where(x < len(self.fol.name2domain[name].constants),
-                              True, False) for name,x in X_domains.items()}
-            X_domains_fixed = {
-                name:tf.where(X_domains_fixed_mask[name], x, 0)
-                for name,x in X_domains.items()}
+            # Partition the constants in fixed (0) and adaptive (1) ones, so
+            # that each constant is embedded only by its own embedder.
+            X_domains_fixed = {}
+            X_domains_adaptive = {}
+            X_domains_positions = {}
+            for name,x in X_domains.items():
+                partitions = tf.cast(x >= self._adaptive_thresholds[name],
+                                     tf.int32)
+                X_domains_fixed[name], X_domains_adaptive[name] = (
+                    tf.dynamic_partition(x, partitions, 2))
+                X_domains_positions[name] = tf.dynamic_partition(
+                    tf.range(tf.shape(x)[0]), partitions, 2)
             constant_embeddings_fixed = self.constant_embedder(X_domains_fixed)
             constant_embeddings_adaptive = self.adaptive_constant_embedder(
-                X_domains)
+                X_domains_adaptive)
+            # Gather the embeddings back following the input order, the
+            # inverse permutation of the partition positions avoids the
+            # data-dependent indices of a dynamic_stitch.
             constant_embeddings = {
-                name:tf.where(
-                    # Expand dim to broadcast to the embeddings size.
-                    tf.expand_dims(X_domains_fixed_mask[name], axis=-1),
-                    constant_embeddings_fixed[name],
-                    constant_embeddings_adaptive[name])
+                name:tf.gather(
+                    tf.concat([constant_embeddings_fixed[name],
+                               constant_embeddings_adaptive[name]], axis=0),
+                    tf.math.invert_permutation(
+                        tf.concat(X_domains_positions[name], axis=0)))
                 for name in X_domains.keys()}
-            tf.print('EMB', {
-                name:tf.boolean_mask(
-                    constant_embeddings_adaptive[name],
-                    tf.math.logical_not(
-                        X_domains_fixed_mask[name]))
-                for name in X_domains.keys()})
+            if self._debug:
+                tf.print('EMB', constant_embeddings_adaptive)
+        elif self._single_domain_name is not None:
+            # The constants are embedded directly by the triplet gather.
+            constant_embeddings = None
         else:
+            # Multiple domains, the constants are embedded per domain and only
+            # the batch embeddings are packed, not the full domain tables.
             constant_embeddings = self.constant_embedder(X_domains)
 
-        predicate_embeddings = self.predicate_embedder(self.predicate_index_tensor)
+        # Shape PE, the predicate table is used as is: gathering all the
+        # predicates in order would just copy it. It is prepared by the KGE
+        # once per call, as all the triplets share its P rows, from the float32
+        # table, which is cast by the KGE to the compute dtype.
+        predicate_embeddings = self.kge_embedder.prepare_relations(
+            self.predicate_embedder.weights_matrix, training=training)
         # Shape TE, T2E with T number of triplets.
         predicate_embeddings_per_triplets, constant_embeddings_for_triplets = \
-            self.create_triplets(constant_embeddings, predicate_embeddings, A_predicates)
+            self.create_triplets(X_domains, constant_embeddings,
+                                 predicate_embeddings, A_predicates)
 
         # Shape TE
+        # The training flag is the one given to prepare_relations().
         atom_embeddings = self.kge_embedder((predicate_embeddings_per_triplets,
-                                             constant_embeddings_for_triplets))
-        # Shape T1
-        atom_outputs = tf.expand_dims(self.output_layer(atom_embeddings), -1)
+                                             constant_embeddings_for_triplets),
+                                            training=training)
+        # Shape T, outputs are in float32 to preserve the loss numerics.
+        atom_outputs = tf.cast(self.output_layer(atom_embeddings), tf.float32)
         return atom_outputs, atom_embeddings
 
 
@@ -166,7 +238,8 @@ class CollectiveModel(Model):
                  dot_product: bool,
                  cdcr_use_positional_embeddings: bool,
                  cdcr_num_formulas: int,
-                 r2n_prediction_type: str):
+                 r2n_prediction_type: str,
+                 debug: bool=False):
         super().__init__()
         # Reasoning depth of the model structure.
         self.reasoner_depth = reasoner_depth
@@ -174,9 +247,11 @@ class CollectiveModel(Model):
         # self.reasoner_depth during multi-stage learning (like if
         # pretraining the KGEs).
         self.enabled_reasoner_depth = reasoner_depth
+        self.reasoner_single_model = reasoner_single_model
         self.resnet = resnet
         self.embedding_resnet = embedding_resnet
         self.logic = GodelTNorm()
+        self._debug = debug
 
         self.kge_model = KGEModel(fol, kge,
                                   kge_regularization,
@@ -185,7 +260,8 @@ class CollectiveModel(Model):
                                   kge_atom_embedding_size,
                                   kge_dropout_rate,
                                   num_adaptive_constants,
-                                  dot_product)
+                                  dot_product,
+                                  debug)
         self.model_name = model_name
 
         # REASONING LAYER
@@ -202,6 +278,9 @@ class CollectiveModel(Model):
                           activation='sigmoid')])
 
             self.reasoning = []
+            # Stateless, shared by the R2N layers of all depths.
+            r2n_output_layer = (SumAndSigmoid(name='output_layer')
+                                if kge == 'rotate' else self.kge_model.output_layer)
             for i in range(reasoner_depth):
               if i > 0 and reasoner_single_model:
                   self.reasoning.append(self.reasoning[0])
@@ -232,17 +311,13 @@ class CollectiveModel(Model):
                       dropout_rate=reasoner_dropout_rate))
 
               elif model_name == 'r2n':
-                  def SumAndSigmoidOutput(x):
-                      return tf.nn.sigmoid(tf.reduce_sum(x, axis=-1))
-                  output_layer = (Lambda(SumAndSigmoidOutput, name='output_layer')
-                                  if kge == 'rotate' else self.kge_model.output_layer)
                   self.reasoning.append(R2NReasoningLayer(
                       rules=rules,
                       formula_hidden_size=reasoner_formula_hidden_embedding_size,
                       atom_embedding_size=reasoner_atom_embedding_size,
                       prediction_type=r2n_prediction_type,
                       aggregation_type=aggregation_type,
-                      output_layer=output_layer,
+                      output_layer=r2n_output_layer,
                       regularization=reasoner_regularization,
                       dropout_rate=reasoner_dropout_rate))
 
@@ -277,6 +352,39 @@ class CollectiveModel(Model):
     def explain_mode(self, mode=True):
         self._explain_mode = mode
 
+    def debug_mode(self, mode=True):
+        self._debug = mode
+        self.kge_model.debug_mode(mode)
+
+    # Gated mix of the KGE and reasoned embeddings and the output computed
+    # from the mixed embeddings, fused by XLA when the train step is compiled
+    # with jit_compile.
+    def _apply_embedding_resnet(self, w, concept_embeddings, atom_embeddings):
+        w = tf.clip_by_value(w, 1e-9, 1.0 - 1e-7)
+        atom_embeddings = (1.0 - w) * tf.stop_gradient(concept_embeddings) + w * atom_embeddings
+        task_output = self.kge_model.output_layer(atom_embeddings)
+        return atom_embeddings, task_output
+
+    # Applies the shared reasoning layer enabled_reasoner_depth times. The
+    # first step is run outside of the loop to build the layer, the other ones
+    # in a tf.while_loop to trace the layer graph only once.
+    def _shared_reasoning_loop(self, task_output, atom_embeddings, A_rules):
+        reasoning = self.reasoning[0]
+        task_output, atom_embeddings = reasoning(
+            [task_output, atom_embeddings, A_rules], preprocessed=True)
+
+        def body(i, task_output, atom_embeddings):
+            task_output, atom_embeddings = reasoning(
+                [task_output, atom_embeddings, A_rules], preprocessed=True)
+            return i + 1, task_output, atom_embeddings
+
+        _, task_output, atom_embeddings = tf.while_loop(
+            cond=lambda i, *_: i < self.enabled_reasoner_depth,
+            body=body,
+            loop_vars=(tf.constant(1), task_output, atom_embeddings),
+            parallel_iterations=1)
+        return task_output, atom_embeddings
+
     def call(self, inputs, *args, **kwargs):
         if self._explain_mode:
             # No explanations are posible when reasoning is disabled.
@@ -285,32 +393,47 @@ class CollectiveModel(Model):
             assert self.model_name == 'dcr' or self.model_name == 'cdcr'
 
         # X_domains type is Dict[str, tensor[constant_indices_in_domain]]
-        # A_predicate: Dict[predicate_name, List[Tuple[Index1, ..., IndexN]]]
-        #              e.g. mapping predicate_name -> tensor [num_groundings, arity]
-        #                   with constant indices for each grounding.
+        # A_predicate: Tuple[predicate_idx [T], constant_indices [T, arity]]
+        #              with the predicate and the constant indices of each
+        #              atom, in atom index order.
         (X_domains, A_predicates, A_rules, Q) = inputs
         concept_output, concept_embeddings = self.kge_model((X_domains, A_predicates))
-        task_output = tf.identity(concept_output)
+        task_output = concept_output
 
         explanations = None
         if self.reasoning is not None:
-            atom_embeddings = tf.identity(concept_embeddings)
-            for i in range(self.enabled_reasoner_depth):
-                if self._explain_mode and i == self.enabled_reasoner_depth - 1:
-                    explanations = self.reasoning[i].explain(
-                        [task_output, atom_embeddings, A_rules])
-                task_output, atom_embeddings = self.reasoning[i]([
-                    task_output, atom_embeddings, A_rules])
+            atom_embeddings = concept_embeddings
+            # The reasoning layers take and return outputs with shape T1.
+            task_output = tf.expand_dims(task_output, axis=-1)
+            # All the reasoning steps share the layer type and the rules, the
+            # groundings are prepared once for all of them.
+            A_rules_preprocessed = self.reasoning[0].preprocess_rules(A_rules)
+            if (self.reasoner_single_model and not self._explain_mode and
+                not self.reasoning[0].call_adds_losses and
+                self.enabled_reasoner_depth > 1):
+                task_output, atom_embeddings = self._shared_reasoning_loop(
+                    task_output, atom_embeddings, A_rules_preprocessed)
+            else:
+                for i in range(self.enabled_reasoner_depth):
+                    if self._explain_mode and i == self.enabled_reasoner_depth - 1:
+                        explanations = self.reasoning[i].explain(
+                            [task_output, atom_embeddings, A_rules])
+                    task_output, atom_embeddings = self.reasoning[i]([
+                        task_output, atom_embeddings, A_rules_preprocessed],
+                        preprocessed=True)
             if self.embedding_resnet:
                 # In this case we need to recompute the output from the updated embeddings.
-                w = tf.clip_by_value(self.embedding_resnet_weight(tf.concat([concept_embeddings, atom_embeddings], axis=-1)), 1e-9, 1.0 - 1e-7)
-                tf.print('embedding_resnet_weight', tf.reduce_mean(w))
-                atom_embeddings = (1.0 - w) * tf.stop_gradient(concept_embeddings) + w * atom_embeddings
-                task_output = tf.expand_dims(self.kge_model.output_layer(atom_embeddings), axis=-1)
-
-        task_output = tf.gather(params=tf.squeeze(task_output, -1), indices=Q)
-        concept_output = tf.gather(params=tf.squeeze(concept_output, -1),
-                                   indices=Q)
+                w = self.embedding_resnet_weight(tf.concat([concept_embeddings, atom_embeddings], axis=-1))
+                if self._debug:
+                    tf.print('embedding_resnet_weight', tf.reduce_mean(w))
+                atom_embeddings, task_output = self._apply_embedding_resnet(
+                    w, concept_embeddings, atom_embeddings)
+            else:
+                task_output = tf.squeeze(task_output, -1)
+            task_output = tf.cast(task_output, tf.float32)
+
+        task_output = tf.gather(params=task_output, indices=Q)
+        concept_output = tf.gather(params=concept_output, indices=Q)
         if self.resnet and self.reasoning is not None:
             task_output = self.logic.disj_pair(task_output, concept_output)
 
@@ -54,6 +54,13 @@ def main(base_path, output_filename, kge_output_filename, log_filename, args):
     csv_logger = CSVLogger(log_filename, append=True, separator=';')
     print('ARGS', args)
 
+    # Runs the dense layers in bfloat16, the embedding tables are still kept
+    # in float32 and cast after the lookups. The policy is global, so it is
+    # always set to not leak into the following runs of the same process.
+    tf.keras.mixed_precision.set_global_policy(
+        'mixed_bfloat16' if get_arg(args, 'mixed_precision', False)
+        else 'float32')
+
     seed = get_arg(args, 'seed', 0)
     random.seed(seed)
     np.random.seed(seed)
@@ -157,23 +164,27 @@ def main(base_path, output_filename, kge_output_filename, log_filename, args):
             args, 'cdcr_use_positional_embeddings', True),
         cdcr_num_formulas=get_arg(args, 'cdcr_num_formulas', 3),
         r2n_prediction_type=get_arg(args, 'r2n_prediction_type', 'full'),
+        debug=get_arg(args, 'debug', False),
     )
 
     # Preparing data as generators for model fit
     print('Build Train generators', flush=True)
     data_gen_train = ns.dataset.DataGenerator(
         dataset_train, fol, serializer, engine,
-        batch_size=args.batch_size, ragged=ragged)
+        batch_size=args.batch_size, ragged=ragged,
+        flat_atoms=True)
 
     print('Build Valid generators', flush=True)
     data_gen_valid = ns.dataset.DataGenerator(
         dataset_valid, fol, serializer, engine,
-        batch_size=args.val_batch_size, ragged=ragged)
+        batch_size=args.val_batch_size, ragged=ragged,
+        flat_atoms=True)
 
     print('Build Test generators', flush=True)
     data_gen_test = ns.dataset.DataGenerator(
         dataset_test, fol, serializer, engine,
-        batch_size=args.test_batch_size, ragged=ragged)
+        batch_size=args.test_batch_size, ragged=ragged,
+        flat_atoms=True)
 
     #print('BATCH_TRAIN', next(iter(data_gen_train))[0], flush=True)
     #print('BATCH_TEST', next(iter(data_gen_test))[0], flush=True)
@@ -211,10 +222,15 @@ def main(base_path, output_filename, kge_output_filename, log_filename, args):
                ns.utils.HitsMetric(3),
                ns.utils.HitsMetric(10),
                ns.utils.AUCPRMetric()]
+    # XLA compiles the train/eval steps in graph mode, fusing the small ops
+    # of the forward pass. Export TF_XLA_FLAGS=--tf_xla_auto_jit=2 to
+    # auto-cluster the graph when the full step can not be compiled.
+    jit_compile = get_arg(args, 'jit_compile', False)
     model.compile(optimizer=optimizer,
                   loss=loss,
                   metrics=metrics,
-                  run_eagerly=True)
+                  run_eagerly=not jit_compile,
+                  jit_compile=jit_compile)
 
     callbacks = []
     callbacks.append(csv_logger)
@@ -260,17 +276,27 @@ def main(base_path, output_filename, kge_output_filename, log_filename, args):
     if explain_enabled and enable_rules and (
             args.model_name == 'dcr' or args.model_name == 'cdcr'):
         model.explain_mode(True)
+        if jit_compile:
+            # The explanations are read with .numpy(), so the predict steps
+            # must run eagerly.
+            model.compile(optimizer=optimizer,
+                          loss=loss,
+                          metrics=metrics,
+                          run_eagerly=True,
+                          jit_compile=False)
         print('\nExplain Train', flush=True)
         print(model.predict(data_gen_train)[-1])
 
         print('\nExplain Test', flush=True)
         data_gen_test_explain = ns.dataset.DataGenerator(
-            dataset_test, fol, serializer, engine, batch_size=-1, ragged=ragged)
+            dataset_test, fol, serializer, engine, batch_size=-1, ragged=ragged,
+            flat_atoms=True)
         print(model.predict(data_gen_test_explain)[-1])
 
         data_gen_test_positive_only = ns.dataset.DataGenerator(
             dataset_test_positive_only, fol, serializer, engine,
-            batch_size=args.test_batch_size, ragged=ragged)
+            batch_size=args.test_batch_size, ragged=ragged,
+            flat_atoms=True)
         for r in model.reasoning[-1].rule_embedders.values():
             r._verbose=True
         print(model.predict(data_gen_test_positive_only)[-1])
@@ -89,6 +89,8 @@ if __name__ == '__main__':
         args.ragged = True
         args.seed = seed
         args.debug = False
+        args.jit_compile = False
+        args.mixed_precision = False
         args.model = None
         args.model_name = model_name
         args.batch_size = 512
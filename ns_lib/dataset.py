@@ -32,7 +32,8 @@ AtomTuples = Union[List[List[AtomId]], Tensor] # a list of groundings (lists of
 
 def _from_strings_to_tensors(fol, serializer,
                              queries, labels, engine, ragged,
-                             constants_features=None, deterministic=True):
+                             constants_features=None, deterministic=True,
+                             flat_atoms=False):
 
     # Symbolic step
     facts_tuple = tuple(fol.facts)
@@ -64,11 +65,30 @@ def _from_strings_to_tensors(fol, serializer,
                                                    dtype=tf.int32)
     # Creating the input dictionaries (atoms as tuples of domains,
     # atoms as dense ids, formulas as tuples of atoms)
-    # Dict[predicate_name, List[Tuple[constants_ids]]]
-    input_atoms_tuples_tf: Dict[PredicateName, ConstantTuples] = {
-        name:tf.constant(tuples, dtype=tf.int32) if len(tuples) > 0 else
-             tf.zeros(shape=(0, fol.name2predicate[name].arity), dtype=tf.int32)
-        for name,tuples in predicate_tuples.items()}
+    if flat_atoms:
+        # Atoms as flat tensors following the atom index order:
+        # (predicate_idx per atom [T], constant_ids per atom [T, arity]).
+        # This requires all the predicates to have the same arity.
+        arity = fol.predicates[0].arity
+        assert all(p.arity == arity for p in fol.predicates)
+        # One predicate lookup per group of atoms, expanded by the group size.
+        predicate_ids = np.repeat(
+            np.array([fol.name2predicate_idx[name]
+                      for name in predicate_tuples.keys()], dtype=np.int32),
+            [len(tuples) for tuples in predicate_tuples.values()])
+        constant_ids = [t for tuples in predicate_tuples.values()
+                        for t in tuples]
+        input_atoms_tuples_tf: Tuple[Tensor, ConstantTuples] = (
+            tf.constant(predicate_ids, dtype=tf.int32),
+            tf.constant(np.array(constant_ids, dtype=np.int32).reshape(
+                [-1, arity])))
+    else:
+        # Dict[predicate_name, List[Tuple[constants_ids]]]
+        input_atoms_tuples_tf: Dict[PredicateName, ConstantTuples] = {
+            name:tf.constant(tuples, dtype=tf.int32) if len(tuples) > 0 else
+                 tf.zeros(shape=(0, fol.name2predicate[name].arity),
+                          dtype=tf.int32)
+            for name,tuples in predicate_tuples.items()}
 
     # Dict[formula_id, List[Tuple[atom_ids]]]
     input_formulas_tf: Dict[FormulaSignature, (AtomTuples, AtomTuples)] = {}
@@ -136,7 +156,8 @@ class DataGenerator(tf.keras.utils.Sequence):
                  deterministic=True,
                  batch_size=None,
                  ragged: bool=False,
-                 name= "None"):
+                 name= "None",
+                 flat_atoms: bool=False):
 
         self.dataset = dataset
         self.deterministic = deterministic
@@ -144,6 +165,7 @@ class DataGenerator(tf.keras.utils.Sequence):
         self.engine = engine
         self.serializer = serializer
         self.ragged = ragged
+        self.flat_atoms = flat_atoms
         self._batch_size = (batch_size
                             if batch_size is not None and batch_size > 0
                             else -1)
@@ -187,7 +209,8 @@ class DataGenerator(tf.keras.utils.Sequence):
             engine=self.engine,
             ragged=self.ragged,
             constants_features=constants_features,
-            deterministic=self.deterministic)
+            deterministic=self.deterministic,
+            flat_atoms=self.flat_atoms)
 
         return (X_domains_data, A_predicates_data, A_rules_data, Q), y
 
@@ -64,7 +64,7 @@ class ConceptReasoningLayer(Layer):
         if self.signed:
             sign_attn = tf.nn.sigmoid(self.sign_nn(x))
         else:  # Keep only positive concepts.
-            sign_attn = tf.ones_like(values, dtype=tf.float32)
+            sign_attn = tf.ones_like(values)
         sign_terms = self.logic.iff_pair(sign_attn, values)
 
         # Attention scores to identify only relevant concepts for a class
@@ -126,8 +126,8 @@ class ConceptReasoningLayer(Layer):
             bce = tf.keras.losses.BinaryCrossentropy(from_logits=False)
             loss = (constrastive_task_loss_weight /
                     tf.cast(num_body_atoms, dtype=tf.float32) *
-                    tf.reduce_sum(bce(preds_contr, self.logic.neg(
-                        baseline_preds_contr))))
+                    tf.cast(tf.reduce_sum(bce(preds_contr, self.logic.neg(
+                        baseline_preds_contr))), dtype=tf.float32))
             # TODO: Should we make the baseline preds crisp to make the bce be used
             # in a more standard way? Or should we just use mse here?
                         # tf.where(baseline_preds_contr > 0.5, 1.0, 0.0)))))  # crispify the baseline.
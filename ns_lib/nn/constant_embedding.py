@@ -7,6 +7,15 @@ import tensorflow_probability as tfp
 
 from ns_lib.logic.commons import Domain
 
+# Packs the per-domain embeddings in a single table, in list order, returning
+# it with the offset of the first row of each domain. The offsets only depend
+# on the shapes, so the packed rows can be gathered with XLA-compilable
+# indices instead of a tf.dynamic_stitch.
+def pack_domain_embeddings(domain_embeddings: List[tf.Tensor]):
+    domain_sizes = tf.stack([tf.shape(e)[0] for e in domain_embeddings])
+    domain_offsets = tf.math.cumsum(domain_sizes, exclusive=True)
+    return tf.concat(domain_embeddings, axis=0), domain_offsets
+
 class ConstantEmbeddings(Layer):
     """Calls the constant rules_embedders, differenciating the behavior of
        the single domains."""
@@ -29,6 +38,15 @@ class ConstantEmbeddings(Layer):
                     len(domain.constants),
                     constant_embedding_sizes_per_domain[domain.name],
                     embeddings_regularizer=L2(regularization))
+                # Build the table upfront, so that it can be accessed directly.
+                self.embedder[domain.name].build((None,))
+        self.has_features = has_features
+
+    # Table with the embeddings of the constants of a domain, it allows to
+    # gather the embeddings directly from it.
+    def domain_weights_matrix(self, domain_name: str) -> tf.Variable:
+        assert not self.has_features
+        return self.embedder[domain_name].embeddings
 
     # domain_inputs is Dict domain->tensor of idx
     def call(self, domain_inputs: Dict[str, tf.Tensor], **kwargs):
@@ -60,6 +78,16 @@ class PredicateEmbeddings(Layer):
         else:
             self.embedder = Embedding(len(predicates), predicate_embedding_size,
                                       embeddings_regularizer=L2(regularization))
+            # Build the table upfront, so that it can be accessed directly.
+            self.embedder.build((None,))
+        self.has_features = has_features
+
+    # Table with the embeddings of all the predicates, this avoids gathering
+    # them when all the predicates are needed.
+    @property
+    def weights_matrix(self) -> tf.Variable:
+        assert not self.has_features
+        return self.embedder.embeddings  #PE
 
     # Inputs is tensor of predicate idx.
     # Output is tensor of embeddings of each predicate.
@@ -113,9 +141,11 @@ class AdaptiveConstantEmbeddings(Layer):
                 adaptive_emb = self.adaptive_constant2relevance[domain.name](embedder_inputs)
                 emb = constant_embeddings[domain.name]  #CE
                 constant2relevance = tf.tensordot(adaptive_emb, tf.transpose(emb), axes=1)
-                max_value = tf.reduce_max(constant2relevance, axis=-1, keepdims=True)
-                mask = tf.cast(tf.equal(constant2relevance, max_value), adaptive_emb.dtype)
-                embedder_outputs[domain.name] = tf.linalg.matmul(mask, emb)
+                # Select the most relevant constant, gathering it instead of
+                # multiplying the embeddings by a materialized one-hot mask.
+                selected = tf.math.argmax(constant2relevance, axis=-1,
+                                         output_type=tf.int32)
+                embedder_outputs[domain.name] = tf.gather(emb, selected, axis=0)
 
             else:
                 # Computes the distribution over the constants.
@@ -7,6 +7,7 @@ import abc
 from typing import List, Tuple
 from collections import OrderedDict
 from ns_lib.logic.commons import Predicate, FOL, Domain
+from ns_lib.nn.constant_embedding import pack_domain_embeddings
 from abc import ABCMeta, abstractmethod
 
 
@@ -24,75 +25,145 @@ class AtomEmbeddingLayer(Layer):
         self.predicates = predicates
         self.embedders = {}
         self.embedder_class = embedder_class
+        # Order in which the domain embeddings are packed in a single table.
+        self.domain_names = list(OrderedDict.fromkeys(
+            d.name for p in predicates for d in p.domains))
+        self.domain_name2idx = {name:i for i,name in enumerate(self.domain_names)}
+
+        # A single dropout shared by all the predicates, applied once per call
+        # to the constant embeddings of each domain instead of by each
+        # predicate embedder on its tuples.
+        self.dropout_layer = (tf.keras.layers.Dropout(rate=dropout_rate)
+                              if dropout_rate > 0.0 else None)
 
         for predicate in self.predicates:
             self.embedders[predicate.name] = self.embedder_class(
                 atom_embedding_size=self.atom_embedding_size,
                 regularization=regularization,
-                dropout_rate=dropout_rate,
+                dropout_rate=0.0,
                 **kwargs)
             # This shoud not be needed.
             #for l in self.embedders[predicate.name].losses:
             #    self.add_loss(l)
 
-    def create_tuples(self, constants_embeddings,
-                      tuples_tensor, predicate_domains):
-        tuple_features_per_predicate = []
-        for i,domain in enumerate(predicate_domains):
-            constants = tf.gather(constants_embeddings[domain.name],
-                                  tf.cast(tuples_tensor[..., i], tf.int32),
-                                  axis=0)
-            tuple_features_per_predicate.append(constants)
+        # The predicates grouped by arity, their tuples are gathered together.
+        self.arity2predicates = OrderedDict()
+        for predicate in self.predicates:
+            self.arity2predicates.setdefault(len(predicate.domains), []).append(
+                predicate)
+        # The packing and the gathers are traced once on flat lists of tensors:
+        # the constants embeddings in domain order and the tuples in predicate
+        # order. The embedders are called out of it, as the losses they add
+        # can not leak out of a tf.function.
+        constant_embedding_size = (
+            self.embedders[predicates[0].name].input_size()
+            if len(predicates) > 0 else None)
+        self.gather_tuples = tf.function(
+            self._gather_tuples,
+            input_signature=[
+                [tf.TensorSpec([None, constant_embedding_size],
+                               self.compute_dtype)
+                 for _ in self.domain_names],
+                [tf.TensorSpec([None, len(p.domains)], tf.int32)
+                 for p in self.predicates]],
+            reduce_retracing=True)
+
+    # Shifts the constant indices of the tuples of a predicate to the rows of
+    # the packed table, returns shape (batch_size, predicate_arity). The tuples
+    # are int32 as built by the dataset, so no cast is needed.
+    def tuple_indices(self, domain_offsets, tuples_tensor, predicate_domains):
+        # Shape (arity) with the offset of the domain of each argument.
+        offsets = tf.gather(domain_offsets,
+                            [self.domain_name2idx[d.name]
+                             for d in predicate_domains])
+        return tuples_tensor + offsets[None, :]
+
+    def create_tuples(self, packed_embeddings, indices):
+        arity = indices.shape[-1]
+        # A single gather for all the arguments, in row-major order.
+        constants = tf.nn.embedding_lookup(packed_embeddings,
+                                           tf.reshape(indices, [-1]))
         # Returns shape (batch_size, predicate_arity, constant_embedding_size)
-        return tf.stack(tuple_features_per_predicate, axis=-2)
+        return tf.reshape(constants,
+                          [-1, arity, packed_embeddings.shape[-1]])
+
+    # Embeds the tuples in input to the predicates by stacking their
+    # constants embeddings, returns the tuple features in predicate order. The
+    # tuples of the predicates with the same arity are gathered together and
+    # split back per predicate, empty predicates just get zero-sized slices.
+    def _gather_tuples(self, domain_embeddings, predicate_tuples):
+        # The domain embeddings are in domain_names order.
+        packed_embeddings, domain_offsets = pack_domain_embeddings(
+            domain_embeddings)
+        name2tuples = {p.name:t for p,t in zip(self.predicates,
+                                                predicate_tuples)}
+        tuple_features = {}
+        for arity_predicates in self.arity2predicates.values():
+            indices = [self.tuple_indices(domain_offsets,
+                                          name2tuples[predicate.name],
+                                          predicate.domains)
+                       for predicate in arity_predicates]
+            features = self.create_tuples(packed_embeddings,
+                                          tf.concat(indices, axis=0))
+            features = tf.split(features,
+                                tf.stack([tf.shape(i)[0] for i in indices]),
+                                axis=0)
+            for predicate,f in zip(arity_predicates, features):
+                tuple_features[predicate.name] = f
+        return [tuple_features[p.name] for p in self.predicates]
 
     def call(self, inputs, **kwargs):
         # This is a GNN-like interface, constants embeddings (dictionary with
         # domain as keys) and atoms (dictionary with predicates as keys and
         # tuples of constants as values).
         constants_embeddings, predicate_to_constant_tuples = inputs
-
-        # Now we embed the tuples in input to the predicates by stacking their
-        # constants embeddings.
-        tuple_features = {}
-        for predicate in self.predicates:
-            if predicate.name not in predicate_to_constant_tuples:
-                continue
-
-            def GetZeros(size: int):
-                def Fn():
-                    arity: int = len(predicate.domains)
-                    return  tf.zeros([0, arity, size], dtype=tf.float32)
-                return Fn
-            def GetTuples():
-                return self.create_tuples(
-                    constants_embeddings=constants_embeddings,
-                    tuples_tensor=predicate_to_constant_tuples[predicate.name],
-                    predicate_domains=predicate.domains)
-            tuple_features[predicate.name] = tf.cond(
-                tf.size(predicate_to_constant_tuples[predicate.name]) == 0,
-                GetZeros(self.embedders[predicate.name].input_size()),
-                GetTuples)
+        # Predicates missing from the inputs get an empty tuples tensor.
+        predicate_tuples = [
+            predicate_to_constant_tuples[p.name]
+            if p.name in predicate_to_constant_tuples else
+            tf.zeros([0, len(p.domains)], dtype=tf.int32)
+            for p in self.predicates]
+        domain_embeddings = [constants_embeddings[name]
+                             for name in self.domain_names]
+        if self.dropout_layer is not None:
+            # Out of the traced gathers, which would fix the training flag.
+            domain_embeddings = [self.dropout_layer(e)
+                                 for e in domain_embeddings]
+        tuple_features = self.gather_tuples(domain_embeddings,
+                                            predicate_tuples)
 
         # Now we embed the tuples (per predicate) using the dynamically defined atom_embedders
         # Each element has shape (B,atom_emb_size).
         predicate_atoms2embeddings = []  # do not use list comprehansion, causes out os scope errors
-        for predicate in self.predicates:
-            embeddings = self.embedders[predicate.name](
-                tuple_features[predicate.name])
+        for predicate,features in zip(self.predicates, tuple_features):
+            if predicate.name not in predicate_to_constant_tuples:
+                continue
+            embeddings = self.embedders[predicate.name](features)
             predicate_atoms2embeddings.append(embeddings)
 
         # Put all the atoms of all the predicates in a unique dense tensor
         embeddings = tf.concat(predicate_atoms2embeddings, axis=0)
 
-        # Specify the last dimension size for the following layers
-        embeddings = tf.reshape(embeddings, [-1, self.atom_embedding_size])
+        # Specify the last dimension size for the following layers, this
+        # only sets the static shape without copying.
+        embeddings = tf.ensure_shape(embeddings, [None, self.atom_embedding_size])
         if self.regularization_n3 > 0.0:
-            abs_embeddings = tf.math.abs(embeddings)
+            x = tf.cast(embeddings, tf.float32)
             self.add_loss(self.regularization_n3 * tf.reduce_sum(
-                abs_embeddings * abs_embeddings * abs_embeddings))
+                x * x * tf.math.abs(x)))
         return embeddings
 
+############################################
+# The KGE outputs reduce the atom embeddings in float32: under a mixed
+# precision policy the embeddings are bfloat16, whose accumulation is
+# imprecise, and the outputs feed the float32 losses.
+def reduce_sum_float32(inputs):
+    return tf.reduce_sum(tf.cast(inputs, tf.float32), axis=-1)
+
+# Sum over the embedding followed by the sigmoid.
+def sum_and_sigmoid(inputs):
+    return tf.nn.sigmoid(reduce_sum_float32(inputs))
+
 ############################################
 # KGE=Layer interface.
 class KGELayer(metaclass=ABCMeta):
@@ -106,6 +177,26 @@ class KGELayer(metaclass=ABCMeta):
     def output_size(self):
         pass
 
+    # Transforms the table of the relation embeddings before it is gathered
+    # per atom, call() gets the gathered rows as p_embeddings. This allows to
+    # compute per-relation quantities once instead of once per atom. The table
+    # is the float32 variable, it is cast to the compute dtype only here, after
+    # any precision sensitive transformation.
+    def prepare_relations(self, predicate_embeddings, training=None):
+        return tf.cast(predicate_embeddings, self.compute_dtype)
+
+    # Adds the l2 and N3 regularizations of the atom embeddings, their l2 loss
+    # is accumulated in float32. The N3 term is the l2 loss of the absolute
+    # values of the embeddings, which is the l2 loss itself.
+    def add_embedding_losses(self, embeddings):
+        if self.regularization <= 0.0 and self.regularization_n3 <= 0.0:
+            return
+        l2 = tf.nn.l2_loss(tf.cast(embeddings, tf.float32))
+        if self.regularization > 0.0:
+            self.add_loss(self.regularization * l2)
+        if self.regularization_n3 > 0.0:
+            self.add_loss(self.regularization_n3 * l2)
+
 ############################################
 class DistMult(KGELayer, Layer):
     def __init__(self, atom_embedding_size, regularization=0.0,
@@ -128,23 +219,18 @@ class DistMult(KGELayer, Layer):
         p_embeddings, c_embeddings = inputs
         p_embeddings = self.dropout_layer(p_embeddings)
         c_embeddings = self.dropout_layer(c_embeddings)
-        embeddings = p_embeddings * tf.reduce_prod(c_embeddings, axis=1)
-        if self.regularization > 0.0:
-            self.add_loss(self.regularization * tf.nn.l2_loss(embeddings))
-        if self.regularization_n3 > 0.0:
-            abs_embeddings = tf.math.abs(embeddings)
-            self.add_loss(self.regularization_n3 *
-                          tf.nn.l2_loss(abs_embeddings))
+        if c_embeddings.shape[1] == 2:
+            # Binary predicates: a single Hadamard chain, no reduction.
+            embeddings = (p_embeddings * c_embeddings[:, 0, :] *
+                          c_embeddings[:, 1, :])
+        else:
+            embeddings = p_embeddings * tf.reduce_prod(c_embeddings, axis=1)
+        self.add_embedding_losses(embeddings)
         return embeddings
 
     @classmethod
     def output_layer(cls):
-        def __internal__(inputs):
-            outputs = tf.reduce_sum(inputs, axis=-1)
-            outputs = tf.nn.sigmoid(outputs)
-            return outputs
-
-        return __internal__
+        return sum_and_sigmoid
 
 ###########################################
 class TransE(KGELayer, Layer):
@@ -152,6 +238,7 @@ class TransE(KGELayer, Layer):
     @classmethod
     def output_layer(cls):
         def __internal__(inputs):
+            inputs = tf.cast(inputs, tf.float32)
             # outputs = 1.0 - 2.0 * (tf.nn.sigmoid(tf.reduce_mean(tf.square(inputs), axis=-1)) - 0.5)
             outputs = -tf.reduce_mean(tf.square(inputs), axis=-1)
             return outputs
@@ -185,12 +272,7 @@ class TransE(KGELayer, Layer):
 
         embeddings = p_embeddings + head - tail
 
-        if self.regularization > 0.0:
-            self.add_loss(self.regularization * tf.nn.l2_loss(embeddings))
-        if self.regularization_n3 > 0.0:
-            abs_embeddings = tf.math.abs(embeddings)
-            self.add_loss(self.regularization_n3 *
-                          tf.nn.l2_loss(abs_embeddings))
+        self.add_embedding_losses(embeddings)
         return embeddings
 
 ###########################################
@@ -198,8 +280,12 @@ class ModE(KGELayer, Layer):
 
     @classmethod
     def output_layer(cls):
+        # The norm is computed directly from the sum of squares, the eps keeps
+        # the sqrt gradient finite at zero.
         def __internal__(inputs):
-            outputs = tf.exp(-tf.norm(inputs, axis=-1))
+            inputs = tf.cast(inputs, tf.float32)
+            outputs = tf.exp(-tf.sqrt(
+                tf.reduce_sum(inputs * inputs, axis=-1) + 1e-12))
             return outputs
         return __internal__
 
@@ -224,19 +310,12 @@ class ModE(KGELayer, Layer):
         p_embeddings = self.dropout_layer(p_embeddings)
         c_embeddings = self.dropout_layer(c_embeddings)
 
-        #head = tf.squeeze(tf.gather(params=c_embeddings, indices=[0], axis=1),axis=1)
-        #tail = tf.squeeze(tf.gather(params=c_embeddings, indices=[1], axis=1), axis=1)
         head = c_embeddings[..., 0, :]
         tail = c_embeddings[..., 1, :]
 
         embeddings = p_embeddings * head - tail
 
-        if self.regularization > 0.0:
-            self.add_loss(self.regularization * tf.nn.l2_loss(embeddings))
-        if self.regularization_n3 > 0.0:
-            abs_embeddings = tf.math.abs(embeddings)
-            self.add_loss(self.regularization_n3 *
-                          tf.nn.l2_loss(abs_embeddings))
+        self.add_embedding_losses(embeddings)
         return embeddings
 
 
@@ -244,11 +323,7 @@ class ComplEx(KGELayer, Layer):
 
     @classmethod
     def output_layer(cls):
-        def __internal__(inputs):
-            outputs = tf.reduce_sum(inputs, axis=-1)
-            outputs = tf.nn.sigmoid(outputs)
-            return outputs
-        return __internal__
+        return sum_and_sigmoid
 
     def __init__(self, atom_embedding_size,
                  regularization=0.0, regularization_n3=0.0,
@@ -269,31 +344,44 @@ class ComplEx(KGELayer, Layer):
         p_embeddings, c_embeddings = inputs
         p_embeddings = self.dropout_layer(p_embeddings)
         c_embeddings = self.dropout_layer(c_embeddings)
-        Rr, Ri = tf.split(p_embeddings, 2, axis=1)
-
-        tf.debugging.assert_equal(tf.shape(Ri)[-1], tf.shape(Rr)[-1])
-
-        head = c_embeddings[..., 0, :]
-        tail = c_embeddings[..., 1, :]
-
-        h_r, h_i = tf.split(head, 2, axis=1)
-        t_r, t_i = tf.split(tail, 2, axis=1)
-
-        e1 = h_r * t_r * Rr
-        e2 = h_i * t_i * Rr
-        e3 = h_r * t_i * Ri
-        e4 = h_i * t_r * Ri
-        embeddings = e1 + e2 + e3 - e4
+        # The real and imaginary parts are stored as the contiguous halves of
+        # the embeddings (a real block followed by an imaginary block), so
+        # they are taken as views of a (..., 2, E) reshape instead of
+        # splitting them. Checked on the static shapes, without runtime ops.
+        assert p_embeddings.shape[-1] % 2 == 0
+        size = p_embeddings.shape[-1] // 2
+        r = tf.reshape(p_embeddings, [-1, 2, size])
+        Rr = r[:, 0, :]
+        Ri = r[:, 1, :]
+        # Shape (B, arity, 2, E)
+        c = tf.reshape(c_embeddings, [-1, c_embeddings.shape[1], 2, size])
+        h_r = c[:, 0, 0, :]
+        h_i = c[:, 0, 1, :]
+        t_r = c[:, 1, 0, :]
+        t_i = c[:, 1, 1, :]
+
+        # The four Hadamard products h_r*t_r*Rr + h_i*t_i*Rr + h_r*t_i*Ri -
+        # h_i*t_r*Ri as a single signed product and reduction over a (4, B, E)
+        # stack, not materialized under XLA.
+        sign = tf.constant([1.0, 1.0, 1.0, -1.0],
+                           dtype=p_embeddings.dtype)[:, None, None]
+        H = tf.stack([h_r, h_i, h_r, h_i], axis=0)
+        T = tf.stack([t_r, t_i, t_i, t_r], axis=0)
+        R = tf.stack([Rr, Rr, Ri, Ri], axis=0)
+        embeddings = tf.reduce_sum(sign * H * T * R, axis=0)
         if self.regularization > 0.0:
-             self.add_loss(self.regularization * (tf.nn.l2_loss(Rr) + tf.nn.l2_loss(Ri)))
+            # Same as the sum of the l2 losses of the real and imaginary
+            # parts, accumulated in float32 under mixed precision.
+            self.add_loss(self.regularization *
+                          tf.nn.l2_loss(tf.cast(p_embeddings, tf.float32)))
         if self.regularization_n3 > 0.0:
-            abs_head = tf.math.abs(head)
-            abs_tail = tf.math.abs(tail)
-            abs_R = tf.math.abs(tf.concat([Rr,Ri], axis=0))
-            self.add_loss(self.regularization_n3 * (
-                tf.reduce_sum(abs_head * abs_head * abs_head) +
-                tf.reduce_sum(abs_tail * abs_tail * abs_tail) +
-                tf.reduce_sum(abs_R * abs_R * abs_R)))
+            # N3 of the head, tail and relation embeddings as a single float32
+            # reduction over their flattened values.
+            x = tf.cast(tf.concat([tf.reshape(c_embeddings[:, :2, :], [-1]),
+                                   tf.reshape(p_embeddings, [-1])], axis=0),
+                        tf.float32)
+            self.add_loss(self.regularization_n3 *
+                          tf.reduce_sum(x * x * tf.math.abs(x)))
         return embeddings
 
 
@@ -316,6 +404,7 @@ class RotatE(KGELayer, Layer):
         assert atom_embedding_size > 0
         self.regularization = regularization
         self.regularization_n3 = regularization_n3
+        self.dropout_rate = dropout_rate
         if dropout_rate > 0.0:
             self.dropout_layer = tf.keras.layers.Dropout(rate=dropout_rate)
         else:
@@ -329,7 +418,7 @@ class RotatE(KGELayer, Layer):
     @classmethod
     def output_layer(cls):
         def __internal__(inputs):
-            outputs = cls.margin - tf.reduce_sum(inputs, axis=-1)  # B,1
+            outputs = cls.margin - reduce_sum_float32(inputs)  # B,1
             outputs = tf.sigmoid(outputs)
             return outputs
         return __internal__
@@ -340,7 +429,7 @@ class RotatE(KGELayer, Layer):
     def output_size(self):
         return self.atom_embedding_size
 
-    def call(self, inputs):
+    def call(self, inputs, training=None):
         """Calculating the score of triples.
         The formula for calculating the score is :math:`\margin - \|h \circ r - t\|`
         Args:
@@ -351,21 +440,28 @@ class RotatE(KGELayer, Layer):
             embeddings: The output embeddings (B, atom_embedding_size)
         """
         p_embeddings, c_embeddings = inputs
-        p_embeddings = self.dropout_layer(p_embeddings)
+        if self.dropout_rate > 0.0 and training:
+            # The gathered rows are the float32 phases, dropped per triplet
+            # before the rotation: a dropped phase is the identity rotation.
+            # tf.nn.dropout does not autocast them to the compute dtype.
+            p_embeddings = tf.cast(
+                self.rotations(tf.nn.dropout(p_embeddings,
+                                             rate=self.dropout_rate),
+                               self.norm_factor),
+                c_embeddings.dtype)
         c_embeddings = self.dropout_layer(c_embeddings)
-
-        head = c_embeddings[..., 0, :]
-        tail = c_embeddings[..., 1, :]
-
-        if tf.shape(head)[0] == 0 or tf.shape(tail)[0] == 0:
-            return tf.zeros([0, self.atom_embedding_size])
-
-        re_head, im_head = tf.split(head, 2, axis=-1)
-        re_tail, im_tail = tf.split(tail, 2, axis=-1)
-
-        phase_relation = p_embeddings * self.norm_factor
-        re_relation = tf.math.cos(phase_relation)
-        im_relation = tf.math.sin(phase_relation)
+        # The real and imaginary parts are the contiguous halves of the
+        # constant embeddings, shape (B, arity, 2, E).
+        size = c_embeddings.shape[-1] // 2
+        c = tf.reshape(c_embeddings, [-1, c_embeddings.shape[1], 2, size])
+        re_head = c[:, 0, 0, :]
+        im_head = c[:, 0, 1, :]
+        re_tail = c[:, 1, 0, :]
+        im_tail = c[:, 1, 1, :]
+
+        r = tf.reshape(p_embeddings, [-1, 2, size])
+        re_relation = r[:, 0, :]
+        im_relation = r[:, 1, :]
         #hadamard = tf.multiply(tf.complex(re_head, im_head),
         #                       tf.complex(re_relation, im_relation))
         #complex_tail = tf.complex(re_tail, im_tail)
@@ -374,9 +470,10 @@ class RotatE(KGELayer, Layer):
         re_score = re_score - re_head
         im_score = im_score - im_head
         # embeddings = re_score - im_score  # (B,atom_emb_size)
+        # No emptiness guard is needed, zero atoms give zero-length outputs.
         embeddings = tf.math.sqrt(tf.maximum(
-            1e-9,
-            re_score * re_score + im_score * im_score))  # (B,atom_emb_size)
+            re_score * re_score + im_score * im_score,
+            1e-9))  # (B,atom_emb_size)
         # embeddings = hadamard - complex_tail
         #if self.regularization > 0.0:
         #    self.add_loss(self.regularization * tf.nn.l2_loss(p_embeddings))
@@ -384,6 +481,28 @@ class RotatE(KGELayer, Layer):
         #    self.add_loss(self.regularization_n3 * tf.nn.l2_loss(embeddings))
         return embeddings
 
+    # The relation embeddings are phases, the rotations are computed once per
+    # relation: p_embeddings in call() are the gathered [cos | sin] rows.
+    # When training with dropout, the phases are returned as they are, as the
+    # dropout is applied to the phases of each triplet in call().
+    def prepare_relations(self, predicate_embeddings, training=None):
+        if self.dropout_rate > 0.0 and training:
+            return predicate_embeddings
+        return tf.cast(self.rotations(predicate_embeddings, self.norm_factor),
+                       self.compute_dtype)
+
+    # norm_factor is a Python float, so it is a trace-time constant that XLA
+    # folds into the cos/sin kernel on the (P, E) table when the train step
+    # is compiled: no per-atom multiply is left. It is not folded into the
+    # predicate table, as it would change the table initialization and the
+    # effective scale of its gradients.
+    @staticmethod
+    def rotations(phases, norm_factor):
+        # The phases are precision sensitive, cos/sin run in float32.
+        phase_relation = tf.cast(phases, tf.float32) * norm_factor
+        return tf.concat([tf.math.cos(phase_relation),
+                          tf.math.sin(phase_relation)], axis=-1)
+
 ############################################
 class Tucker(KGELayer, Layer):
     def __init__(self, atom_embedding_size: int,
@@ -410,6 +529,17 @@ class Tucker(KGELayer, Layer):
     def output_size(self):
         return 1
 
+    # Contracts the core tensor with the head and the tail embeddings. The
+    # (B, E*E) outer product of head and tail is multiplied by the core
+    # reshaped to (E*E, R) in a single matmul, instead of a chain of batched
+    # matmuls through the (B, E, R) product of the head and the core. The
+    # intermediates have the same size when R == E.
+    @staticmethod
+    def core_product(head, tail, W):
+        size = W.shape[0]
+        ht = tf.reshape(head[:, :, None] * tail[:, None, :], [-1, size * size])
+        return tf.matmul(ht, tf.reshape(W, [size * size, -1]))
+
     def call(self, inputs, **kwargs):
         p_embeddings, c_embeddings = inputs
         p_embeddings = self.dropout_layer(p_embeddings)
@@ -417,24 +547,31 @@ class Tucker(KGELayer, Layer):
 
         head = c_embeddings[..., 0, :]  # BE
         tail = c_embeddings[..., 1, :]  # BE
-        W = self.dropout_layer(self.W)  # EER
-        W1 = tf.einsum('bi,itr->btr', head, W)   # BER
-        W2 = tf.einsum('bi,bir->br', tail, W1)   # BR
-        embeddings = tf.expand_dims(tf.einsum('i,i->b', p_embeddings, W2), axis=-1)  # B1
+        # The core is used as is, the dropout is applied to the (B, R)
+        # contraction instead of masking the whole (E, E, R) weight per step.
+        W = tf.cast(self.W, head.dtype)  # EER
+        W2 = self.dropout_layer(self.core_product(head, tail, W))  # BR
+        # Requires relation_embedding_size to match the predicate embeddings.
+        embeddings = tf.reduce_sum(p_embeddings * W2, axis=-1, keepdims=True)  # B1
         if self.regularization > 0.0:
             self.add_loss(self.regularization * tf.nn.l2_loss(self.W))
         return embeddings
 
     @classmethod
     def output_layer(cls):
-        def __internal__(inputs):
-            outputs = tf.nn.sigmoid(outputs)
-            return outputs
-
-        return __internal__
+        return sum_and_sigmoid
 
 
 ####################################
+_KGE_REGISTRY = {
+    'complex': ComplEx,
+    'distmult': DistMult,
+    'tucker': Tucker,
+    'transe': TransE,
+    'rotate': RotatE,
+    'mode': ModE,
+}
+
 def KGEFactory(name: str,
                atom_embedding_size: int,
                regularization: float,
@@ -444,26 +581,20 @@ def KGEFactory(name: str,
   relation_embedding_size = (relation_embedding_size
                              if relation_embedding_size is not None
                              else atom_embedding_size)
-  if name.casefold() == 'complex':
-    return ComplEx(atom_embedding_size, regularization, dropout_rate), ComplEx.output_layer()
-
-  elif name.casefold() == 'distmult':
-    return DistMult(atom_embedding_size, regularization, dropout_rate), \
-           DistMult.output_layer()
-
-  elif name.casefold() == 'tucker':
-    return Tucker(atom_embedding_size, relation_embedding_size,
-                  regularization, dropout_rate), Tucker.output_layer()
-
-  elif name.casefold() == 'transe':
-    return TransE(atom_embedding_size, regularization, dropout_rate), TransE.output_layer()
-
-  elif name.casefold() == 'rotate':
-    return RotatE(atom_embedding_size, regularization, dropout_rate), RotatE.output_layer()
-
-  elif name.casefold() == 'mode':
-    return ModE(atom_embedding_size, regularization, dropout_rate), ModE.output_layer()
-
-  else:
+  key = name.casefold()
+  cls = _KGE_REGISTRY.get(key)
+  if cls is None:
     print('Unknown KGE', name, flush=True)
     return None
+
+  # Built by keyword, the KGEs ignore the arguments they do not take. As in
+  # the original positional calls, dropout_rate is the dropout of Tucker and
+  # the N3 regularization weight of all the other KGEs.
+  if cls is Tucker:
+    args = {'relation_embedding_size': relation_embedding_size,
+            'dropout_rate': dropout_rate}
+  else:
+    args = {'regularization_n3': dropout_rate}
+  return (cls(atom_embedding_size=atom_embedding_size,
+              regularization=regularization, **args),
+          cls.output_layer())
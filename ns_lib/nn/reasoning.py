@@ -11,44 +11,58 @@ from ns_lib.nn.concepts import *
 ##################################################
 # Base class with common functionalities for all reasoning layers.
 class ReasoningLayer(Layer):
+    # Whether call() adds losses (like activity regularizations), these can
+    # not be created inside the body of a tf.while_loop.
+    call_adds_losses = False
+
     def __init__(self):
 
         super().__init__()
 
+    # Prepares the groundings for call(). When the layer is applied multiple
+    # times on the same groundings, this can be done once and the result
+    # passed to call() with preprocessed=True.
+    def preprocess_rules(self, formula_to_atom_tuples):
+        return formula_to_atom_tuples
+
     def _merge_clique_data_by_atom(self,
                                    clique_data, num_atoms,
                                    grounding_indices, max_num_atoms,
                                    aggregation_type):
         grounding_indices = tf.expand_dims(grounding_indices, -1)
+        dtype = clique_data.dtype
         if aggregation_type == 'max':
-            base = tf.float32.min * tf.ones(
-                shape=[max_num_atoms, tf.shape(clique_data)[-1]])
+            base = dtype.min * tf.ones(
+                shape=[max_num_atoms, tf.shape(clique_data)[-1]], dtype=dtype)
             return tf.tensor_scatter_nd_max(
                 base, grounding_indices, clique_data)
 
         elif aggregation_type == 'softmax':
-            base_max = tf.float32.min * tf.ones(
-                shape=[max_num_atoms, tf.shape(clique_data)[-1]])
+            base_max = dtype.min * tf.ones(
+                shape=[max_num_atoms, tf.shape(clique_data)[-1]], dtype=dtype)
             aggregated_by_max = tf.tensor_scatter_nd_max(
                 base_max, grounding_indices, clique_data)
             base_sum = tf.zeros(
-                shape=[max_num_atoms, tf.shape(clique_data)[-1]])
+                shape=[max_num_atoms, tf.shape(clique_data)[-1]], dtype=dtype)
             aggregated_by_sum = tf.tensor_scatter_nd_max(
                 base_sum, grounding_indices, clique_data)
             return tf.divide_no_nan(aggregated_by_max, aggregated_by_sum)
 
         elif aggregation_type == 'sum':
-            base = tf.zeros([max_num_atoms, tf.shape(clique_data)[-1]])
+            base = tf.zeros([max_num_atoms, tf.shape(clique_data)[-1]],
+                            dtype=dtype)
             return tf.tensor_scatter_nd_add(
                 base, grounding_indices, clique_data)
 
         elif aggregation_type == 'mean':
-            base = tf.zeros([max_num_atoms, tf.shape(clique_data)[-1]])
+            base = tf.zeros([max_num_atoms, tf.shape(clique_data)[-1]],
+                            dtype=dtype)
             aggregated_sum = tf.tensor_scatter_nd_add(
                 base, grounding_indices, clique_data)
             num_groundings = tf.shape(grounding_indices)[0]
-            ones_for_avg = tf.ones(shape=[num_groundings, num_atoms, 1])
-            base_count = tf.zeros([max_num_atoms, 1])
+            ones_for_avg = tf.ones(shape=[num_groundings, num_atoms, 1],
+                                   dtype=dtype)
+            base_count = tf.zeros([max_num_atoms, 1], dtype=dtype)
             count = tf.tensor_scatter_nd_add(base_count, grounding_indices,
                                              ones_for_avg)
             return tf.math.divide_no_nan(aggregated_sum, count)
@@ -132,10 +146,28 @@ class R2NReasoningLayer(ReasoningLayer):
 
         self.aggregation_type = aggregation_type
 
-    def call(self, inputs):
+    # In full prediction mode, all the atoms of a grounding are both input
+    # and output, the concatenation is shared by all the calls.
+    def preprocess_rules(self, formula_to_atom_tuples):
+        if self.prediction_type != 'full':
+            return formula_to_atom_tuples
+        preprocessed = {}
+        for rule in self.rules:
+            assert rule.name in formula_to_atom_tuples, (
+                '%s missing in rules %s' % (
+                    rule.name, list(formula_to_atom_tuples.keys())))
+            (A_in, A_out) = formula_to_atom_tuples[rule.name]
+            A = tf.concat((A_in, A_out), axis=1)
+            preprocessed[rule.name] = (A, A)
+        return preprocessed
+
+    def call(self, inputs, preprocessed: bool=False):
         input_concepts, input_atom_embeddings, formula_to_atom_tuples = inputs
         num_atoms = tf.shape(input_atom_embeddings)[0]
         input_atom_embedding_size = tf.shape(input_atom_embeddings)[-1]
+        if not preprocessed:
+            formula_to_atom_tuples = self.preprocess_rules(
+                formula_to_atom_tuples)
 
         atom_embeddings_all_formulas = []
 
@@ -145,9 +177,6 @@ class R2NReasoningLayer(ReasoningLayer):
                     rule.name, list(formula_to_atom_tuples.keys())))
             (A_in, A_out) = formula_to_atom_tuples[rule.name]
             if self.prediction_type == 'full':
-                A = tf.concat((A_in, A_out), axis=1)
-                A_in = A
-                A_out = A
                 num_atoms_out = len(rule.head) + len(rule.body)
                 num_atoms_in = len(rule.head) + len(rule.body)
             else:
@@ -185,6 +214,7 @@ class R2NReasoningLayer(ReasoningLayer):
 
 ###############################################
 class DCRReasoningLayer(ReasoningLayer):
+    call_adds_losses = True
 
     def __init__(self,
                  templates: List[Rule],
@@ -227,7 +257,7 @@ class DCRReasoningLayer(ReasoningLayer):
 
     # Takes concepts, atom embeddings, grounding structures and returns the
     # predictions.
-    def call(self, inputs):
+    def call(self, inputs, preprocessed: bool=False):
         input_concepts, input_atom_embeddings, formula_to_atom_tuples = inputs
         num_atoms = tf.shape(input_atom_embeddings)[0]
         input_atom_embedding_size = tf.shape(input_atom_embeddings)[-1]
@@ -371,7 +401,7 @@ class ClusteredDCRReasoningLayer(DCRReasoningLayer):
 
     # Takes concepts, atom embeddings, grounding structures and returns the
     # predictions.
-    def call(self, inputs):
+    def call(self, inputs, preprocessed: bool=False):
         input_concepts, input_atom_embeddings, formula_to_atom_tuples = inputs
         num_atoms = tf.shape(input_atom_embeddings)[0]
         input_atom_embedding_size = tf.shape(input_atom_embeddings)[-1]
@@ -500,7 +530,7 @@ class SBRReasoningLayer(ReasoningLayer):
         self.aggregation_type = aggregation_type
 
     # TODO: add explain mode.
-    def call(self, inputs):
+    def call(self, inputs, preprocessed: bool=False):
         input_atom_predictions, input_atom_embeddings, formula_to_atom_tuples = inputs
         num_atoms = tf.shape(input_atom_embeddings)[0]
         input_atom_embedding_size = tf.shape(input_atom_embeddings)[-1]
@@ -574,7 +604,7 @@ class _GatedSBRReasoningLayerBase(SBRReasoningLayer):
 
 
     # TODO: add explain mode.
-    def call(self, inputs):
+    def call(self, inputs, preprocessed: bool=False):
         input_atom_predictions, input_atom_embeddings, formula_to_atom_tuples = inputs
         num_atoms = tf.shape(input_atom_embeddings)[0]
         input_atom_embedding_size = tf.shape(input_atom_embeddings)[-1]
@@ -701,7 +731,7 @@ class DeepStocklogLayer(SBRReasoningLayer):
 
 
     # TODO: add explain mode.
-    def call(self, inputs):
+    def call(self, inputs, preprocessed: bool=False):
         input_atom_predictions, input_atom_embeddings, formula_to_atom_tuples = inputs
         num_atoms = tf.shape(input_atom_embeddings)[0]
         input_atom_embedding_size = tf.shape(input_atom_embeddings)[-1]